@@ -1,19 +1,73 @@
 import asyncio
 import aiosqlite
 import os
-from typing import Optional, Tuple
+import time
+from typing import Iterable, Optional, Tuple
 
 DB_PATH = os.getenv("DB_PATH", "bot.sqlite3")
 
+# Одно долгоживущее соединение на процесс (создается в init_db)
+_conn: Optional[aiosqlite.Connection] = None
+# SQLite все равно сериализует запись — держим один лок на писателей
+_write_lock = asyncio.Lock()
+
+ADD_CODES_CHUNK = 10_000
+EXPORT_FETCH_SIZE = 1_000
+
+# Кэш настроек в процессе: key -> (время чтения, значение)
+_setting_cache: dict[str, tuple[float, Optional[str]]] = {}
+_SETTING_TTL = 30.0
+
+# Горячие запросы — константы: sqlite3 кэширует подготовленные выражения
+# по тексту SQL на соединение, так что при общем соединении они парсятся один раз
+SQL_GET_SETTING = "SELECT value FROM settings WHERE key=?"
+SQL_SET_SETTING = "INSERT INTO settings(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value"
+SQL_UPSERT_USER = "INSERT OR IGNORE INTO users(user_id, username, first_seen) VALUES(?,?,?)"
+SQL_COUNT_AVAILABLE = "SELECT COUNT(*) FROM promo_codes WHERE used_by IS NULL"
+SQL_TAKE_CODE = (
+    "UPDATE promo_codes SET used_by=?, used_at=? "
+    "WHERE code=(SELECT code FROM promo_codes WHERE used_by IS NULL LIMIT 1) "
+    "RETURNING code, used_at"
+)
+SQL_ADD_CODE = "INSERT OR IGNORE INTO promo_codes(code) VALUES(?)"
+SQL_EXPORT_CODES = "SELECT code FROM promo_codes WHERE used_by IS NULL"
+SQL_EXPORT_CODES_LIMIT = "SELECT code FROM promo_codes WHERE used_by IS NULL LIMIT ?"
+SQL_GET_GIFT_RECEIVED = "SELECT gift_received_at FROM users WHERE user_id=?"
+SQL_MARK_GIFT_SENT = "UPDATE users SET gift_received_at=? WHERE user_id=?"
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    global _conn
+    if _conn is None:
+        _conn = await aiosqlite.connect(DB_PATH)
+    db = _conn
+    async with _write_lock:
+        # WAL + synchronous=NORMAL: меньше fsync на коммит, читатели не блокируют писателя
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute("PRAGMA temp_store=MEMORY")
+        await db.execute("PRAGMA cache_size=-64000")
+        await db.execute("PRAGMA mmap_size=67108864")
         await db.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
-            first_seen INTEGER
+            first_seen INTEGER,
+            gift_received_at INTEGER
         );
         """)
+        # миграция для старых БД без колонки gift_received_at
+        cur = await db.execute("PRAGMA table_info(users)")
+        columns = {row[1] for row in await cur.fetchall()}
+        if "gift_received_at" not in columns:
+            await db.execute("ALTER TABLE users ADD COLUMN gift_received_at INTEGER")
+            # переносим старые отметки gift_received_{user_id} из settings
+            await db.execute("""
+            UPDATE users SET gift_received_at=(
+                SELECT CAST(value AS INTEGER) FROM settings WHERE key='gift_received_' || users.user_id
+            )
+            WHERE EXISTS (SELECT 1 FROM settings WHERE key='gift_received_' || users.user_id)
+            """)
+            await db.execute("DELETE FROM settings WHERE key LIKE 'gift\\_received\\_%' ESCAPE '\\'")
         await db.execute("""
         CREATE TABLE IF NOT EXISTS promo_codes (
             code TEXT PRIMARY KEY,
@@ -21,6 +75,8 @@ async def init_db():
             used_at INTEGER
         );
         """)
+        # частичный индекс только по свободным кодам — под LIMIT 1 / COUNT(*) / выгрузку
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_promo_unused ON promo_codes(code) WHERE used_by IS NULL")
         await db.execute("""
         CREATE TABLE IF NOT EXISTS settings (
             key TEXT PRIMARY KEY,
@@ -29,66 +85,124 @@ async def init_db():
         """)
         await db.commit()
 
+async def close_db():
+    global _conn
+    if _conn is not None:
+        await _conn.close()
+        _conn = None
+
 async def get_setting(key: str) -> Optional[str]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT value FROM settings WHERE key=?", (key,))
-        row = await cur.fetchone()
-        return row[0] if row else None
+    cached = _setting_cache.get(key)
+    if cached and time.monotonic() - cached[0] < _SETTING_TTL:
+        return cached[1]
+    db = _conn
+    cur = await db.execute(SQL_GET_SETTING, (key,))
+    row = await cur.fetchone()
+    value = row[0] if row else None
+    _setting_cache[key] = (time.monotonic(), value)
+    return value
+
+async def get_settings(keys: Iterable[str]) -> dict[str, str]:
+    # несколько настроек одним запросом WHERE key IN (...); отсутствующих ключей в ответе нет
+    now = time.monotonic()
+    result: dict[str, str] = {}
+    missing: list[str] = []
+    for key in dict.fromkeys(keys):
+        cached = _setting_cache.get(key)
+        if cached and now - cached[0] < _SETTING_TTL:
+            if cached[1] is not None:
+                result[key] = cached[1]
+        else:
+            missing.append(key)
+    if missing:
+        db = _conn
+        placeholders = ",".join("?" * len(missing))
+        cur = await db.execute(f"SELECT key, value FROM settings WHERE key IN ({placeholders})", missing)
+        found = dict(await cur.fetchall())
+        for key in missing:
+            value = found.get(key)
+            _setting_cache[key] = (now, value)
+            if value is not None:
+                result[key] = value
+    return result
 
 async def set_setting(key: str, value: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO settings(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
+    db = _conn
+    async with _write_lock:
+        await db.execute(SQL_SET_SETTING, (key, value))
         await db.commit()
+        _setting_cache[key] = (time.monotonic(), value)
 
 async def upsert_user(user_id: int, username: Optional[str]):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR IGNORE INTO users(user_id, username, first_seen) VALUES(?,?,strftime('%s','now'))",
-            (user_id, username)
-        )
+    db = _conn
+    async with _write_lock:
+        await db.execute(SQL_UPSERT_USER, (user_id, username, int(time.time())))
         await db.commit()
 
 async def count_available_codes() -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM promo_codes WHERE used_by IS NULL")
-        row = await cur.fetchone()
-        return row[0] if row else 0
+    db = _conn
+    cur = await db.execute(SQL_COUNT_AVAILABLE)
+    row = await cur.fetchone()
+    return row[0] if row else 0
 
 async def take_code_for_user(user_id: int) -> Optional[Tuple[str, int]]:
     # Возвращает (code, used_at)
-    async with aiosqlite.connect(DB_PATH) as db:
-        # пытаемся взять любой неиспользованный код
-        cur = await db.execute("SELECT code FROM promo_codes WHERE used_by IS NULL LIMIT 1")
-        row = await cur.fetchone()
+    db = _conn
+    async with _write_lock:
+        # берем и помечаем любой неиспользованный код одним запросом — без гонки между SELECT и UPDATE
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            cur = await db.execute(SQL_TAKE_CODE, (user_id, int(time.time())))
+            row = await cur.fetchone()
+            await db.commit()
+        except BaseException:
+            # не оставляем общее соединение внутри открытой транзакции
+            await db.rollback()
+            raise
         if not row:
             return None
-        code = row[0]
-        await db.execute("UPDATE promo_codes SET used_by=?, used_at=strftime('%s','now') WHERE code=?", (user_id, code))
-        await db.commit()
-        return code, await get_unix_now()
+        return row[0], int(row[1])
 
 async def add_codes(codes: list[str]):
     if not codes:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executemany("INSERT OR IGNORE INTO promo_codes(code) VALUES(?)", [(c,) for c in codes])
-        await db.commit()
+    db = _conn
+    async with _write_lock:
+        # большие импорты режем на транзакции по ADD_CODES_CHUNK строк
+        for i in range(0, len(codes), ADD_CODES_CHUNK):
+            chunk = codes[i:i + ADD_CODES_CHUNK]
+            try:
+                await db.execute("BEGIN")
+                await db.executemany(SQL_ADD_CODE, ((c,) for c in chunk))
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
 
-async def get_unix_now() -> int:
-    # используем системное время, БД тоже хранит в unixtime
-    import time
-    return int(time.time())
+async def export_remaining_codes_bytes(limit: int | None = None) -> bytes:
+    # Свободные коды в UTF-8, по одному на строку; строки читаем потоком, без промежуточного списка
+    db = _conn
+    if limit:
+        sql, params = SQL_EXPORT_CODES_LIMIT, (limit,)
+    else:
+        sql, params = SQL_EXPORT_CODES, ()
+    buf = bytearray()
+    async with db.execute(sql, params) as cur:
+        cur.iter_chunk_size = EXPORT_FETCH_SIZE
+        async for (code,) in cur:
+            buf += code.encode("utf-8")
+            buf.append(0x0A)
+    return bytes(buf)
 
-async def export_remaining_codes(limit: int | None = None) -> list[str]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        if limit:
-            cur = await db.execute("SELECT code FROM promo_codes WHERE used_by IS NULL LIMIT ?", (limit,))
-        else:
-            cur = await db.execute("SELECT code FROM promo_codes WHERE used_by IS NULL")
-        rows = await cur.fetchall()
-        return [r[0] for r in rows]
+async def get_gift_received_at(user_id: int) -> Optional[int]:
+    db = _conn
+    cur = await db.execute(SQL_GET_GIFT_RECEIVED, (user_id,))
+    row = await cur.fetchone()
+    return row[0] if row else None
 
 async def mark_gift_sent(user_id: int):
-    # запасной лог, если захотите статистику по Star Gifts
-    key = f"gift_sent_to_{user_id}"
-    await set_setting(key, str(await get_unix_now()))
+    # отмечаем выдачу подарка прямо в users (для ONLY_ONCE и статистики)
+    db = _conn
+    async with _write_lock:
+        await db.execute(SQL_MARK_GIFT_SENT, (int(time.time()), user_id))
+        await db.commit()
@@ -1,19 +1,27 @@
 import os
 import json
+import logging
+import re
 import time
 import asyncio
+import orjson
 from typing import Any, Dict, List, Optional
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, Router, F, types
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 
+try:
+    from aiogram.methods import SendGift  # Bot API 8.0+, есть не во всех версиях aiogram 3.x
+except ImportError:
+    SendGift = None
+
 import db
-from db import init_db, upsert_user, count_available_codes, take_code_for_user, add_codes, export_remaining_codes, get_setting, set_setting
+from db import init_db, close_db, upsert_user, count_available_codes, take_code_for_user, add_codes, export_remaining_codes_bytes, get_setting, get_gift_received_at, mark_gift_sent
 
 load_dotenv()
 
@@ -29,6 +37,10 @@ WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
 WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg/webhook").strip()
 PORT = int(os.getenv("PORT", "8080"))
 REDIS_URL = os.getenv("REDIS_URL", "").strip()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
 
 # Если нет токена — выходим
 if not BOT_TOKEN:
@@ -57,64 +69,78 @@ def to_channel_id(channel: str) -> str:
         return channel
     return channel
 
+# Клавиатур всего две — собираем их один раз при импорте
+_KB_READY = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=GIFT_NAME, callback_data="claim:gift")],
+])
+_KB_PENDING = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=GIFT_NAME, callback_data="claim:gift")],
+    [InlineKeyboardButton(text="🔔 Я подписался(ась)", callback_data="check_sub")],
+])
+
 def build_claim_keyboard(pending: bool = False) -> InlineKeyboardMarkup:
-    kb = [
-        [InlineKeyboardButton(text=GIFT_NAME, callback_data="claim:gift")],
-    ]
-    if pending:
-        kb.append([InlineKeyboardButton(text="🔔 Я подписался(ась)", callback_data="check_sub")])
-    return InlineKeyboardMarkup(inline_keyboard=kb)
+    return _KB_PENDING if pending else _KB_READY
+
+# Положительные проверки подписки: (channel, user_id) -> monotonic-время истечения
+_SUB_TTL = 120.0
+_SUB_CACHE_MAX = 10_000
+_sub_cache: dict[tuple[str, int], float] = {}
 
 async def is_subscribed(bot: Bot, user_id: int, channel: str) -> bool:
     ch = to_channel_id(channel)
+    key = (ch, user_id)
+    if _sub_cache.get(key, 0.0) > time.monotonic():
+        return True
     try:
         member = await bot.get_chat_member(chat_id=ch, user_id=user_id)
-        return member.status in ("member", "administrator", "creator")
+        if member.status in ("member", "administrator", "creator"):
+            # отрицательный результат не кэшируем — пользователь может подписаться в любой момент
+            now = time.monotonic()
+            if key not in _sub_cache and len(_sub_cache) >= _SUB_CACHE_MAX:
+                for k in [k for k, exp in _sub_cache.items() if exp <= now]:
+                    del _sub_cache[k]
+                if len(_sub_cache) >= _SUB_CACHE_MAX:
+                    # истекших нет — вытесняем самую старую запись
+                    del _sub_cache[next(iter(_sub_cache))]
+            _sub_cache[key] = now + _SUB_TTL
+            return True
+        _sub_cache.pop(key, None)
+        return False
     except Exception:
         # Если бот не админ, get_chat_member вернет ошибку
         return False
 
 async def try_send_star_gift(bot: Bot, user_id: int, gift_id: str, text: Optional[str] = None) -> bool:
-    # Проверяем доступность метода sendGift
-    method = bot.session.session.api_object.api_request
-    if not hasattr(method, "__self__"):
-        # aiogram 3.x не раскрывает напрямую метод Bot API, используем низкоуровневый вызов
-        pass
-
-    # Формируем запрос вручную через Bot API
-    payload = {
-        "user_id": user_id,
-        "gift_id": gift_id,
-    }
-    if text:
-        payload["text"] = text
-    # photo можно передать как Upload или URL
-    # payload["photo"] = ...  # опционально
-
+    if SendGift is None:
+        # установленная версия aiogram еще не знает метод sendGift
+        return False
     try:
-        # используем низкоуровневый вызов
-        from aiogram.methods import SendGift
-        req = SendGift(**payload)
-        resp = await bot(req)
-        # aiogram вернет объект Response с полем ok и result
-        return getattr(resp, "ok", True)  # допускаем, что ok=True
+        if text:
+            req = SendGift(user_id=user_id, gift_id=gift_id, text=text)
+        else:
+            req = SendGift(user_id=user_id, gift_id=gift_id)
+        # sendGift возвращает True при успехе
+        return bool(await bot(req))
     except Exception as e:
         # логируем и возвращаем False
-        print(f"sendGift failed: {e}")
+        logger.warning("sendGift failed: %s", e)
         return False
 
 async def safe_send_text(bot: Bot, chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
     try:
         await bot.send_message(chat_id, text, reply_markup=reply_markup)
     except Exception as e:
-        print(f"send_message failed: {e}")
+        logger.warning("send_message failed: %s", e)
+
+_PROMO_PREFIX = "🎉 Ваш промокод: <code>"
+_PROMO_SUFFIX = "</code>\nИспользуйте его в боте/на сайте."
 
 async def try_send_promo(bot: Bot, user_id: int, code: str) -> bool:
     try:
-        await bot.send_message(user_id, f"🎉 Ваш промокод: <code>{code}</code>\nИспользуйте его в боте/на сайте.", parse_mode="HTML")
+        await bot.send_message(user_id, _PROMO_PREFIX + code + _PROMO_SUFFIX, parse_mode="HTML")
         return True
     except Exception as e:
-        print(f"send promo failed: {e}")
+        logger.warning("send promo failed: %s", e)
         return False
 
 # ---------- States ----------
@@ -122,25 +148,39 @@ class GiftState(StatesGroup):
     waiting_claim = State()
 
 # ---------- Filters ----------
+# Разобранный список админов, перечитывается не чаще раза в ADMINS_TTL секунд
+ADMINS_TTL = 30.0
+_admin_ids: frozenset[int] = frozenset()
+_admin_ids_loaded_at = float("-inf")
+
+def parse_admin_ids(admins_raw: str) -> frozenset[int]:
+    return frozenset(int(x.strip()) for x in admins_raw.split(",") if x.strip().isdigit())
+
 class IsAdmin:
     async def __call__(self, message: Message) -> bool:
         # проверяем, что юзер — админ из настроек или список через запятую
-        admins_raw = (await get_setting("admins")) or os.getenv("ADMINS", "")
-        if not admins_raw:
-            return False
-        ids = [int(x.strip()) for x in admins_raw.split(",") if x.strip().isdigit()]
-        return message.from_user.id in ids
+        global _admin_ids, _admin_ids_loaded_at
+        now = time.monotonic()
+        if now - _admin_ids_loaded_at > ADMINS_TTL:
+            admins_raw = (await get_setting("admins")) or os.getenv("ADMINS", "")
+            _admin_ids = parse_admin_ids(admins_raw)
+            _admin_ids_loaded_at = now
+        return message.from_user is not None and message.from_user.id in _admin_ids
 
 # ---------- Handlers ----------
+_CODE_SPLIT_RE = re.compile(r"[,\s]+")
+
 @router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
     user = message.from_user
     if not user:
         return
-    await upsert_user(user.id, user.username)
-    await state.clear()
-    # Проверяем подписку
-    sub = await is_subscribed(message.bot, user.id, REQUIRE_CHANNEL)
+    # Запись в БД и проверка подписки (запрос к Telegram) независимы — выполняем параллельно
+    async with asyncio.TaskGroup() as tg:
+        t_sub = tg.create_task(is_subscribed(message.bot, user.id, REQUIRE_CHANNEL))
+        tg.create_task(upsert_user(user.id, user.username))
+        await state.clear()
+    sub = t_sub.result()
 
     if sub:
         await safe_send_text(
@@ -174,28 +214,26 @@ async def cmd_balance(message: Message):
     await message.answer(f"Промокодов осталось: {left}")
 
 @router.message(Command("export"), IsAdmin())
-async def cmd_export(message: Message):
+async def cmd_export(message: Message, command: CommandObject):
     limit = None
-    parts = message.get_args().strip().split()
+    parts = (command.args or "").split()
     if parts and parts[0].isdigit():
         limit = int(parts[0])
-    codes = await export_remaining_codes(limit)
-    if not codes:
+    data = await export_remaining_codes_bytes(limit)
+    if not data:
         await message.answer("Нет доступных кодов.")
         return
     # Отправляем отдельным файлом
-    txt = "\n".join(codes)
-    await message.answer_document(types.BufferedInputFile(txt.encode("utf-8"), filename="promo_codes.txt"))
+    await message.answer_document(types.BufferedInputFile(data, filename="promo_codes.txt"))
 
 @router.message(Command("add"), IsAdmin())
-async def cmd_add(message: Message):
+async def cmd_add(message: Message, command: CommandObject):
     # добавить коды из аргументов (через пробел/запятую/перенос)
-    text = message.get_args().strip()
+    text = (command.args or "").strip()
     if not text:
         await message.answer("Использование: /add CODE1 CODE2 CODE3 ...")
         return
-    raw = text.replace(",", " ").replace("\n", " ")
-    codes = [c.strip() for c in raw.split() if c.strip()]
+    codes = [c for c in _CODE_SPLIT_RE.split(text) if c]
     await add_codes(codes)
     await message.answer(f"Добавлено кодов: {len(codes)}")
 
@@ -231,10 +269,11 @@ async def cb_claim(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     if not user:
         return
-    await upsert_user(user.id, user.username)
-
-    # Доп. проверка подписки перед выдачей
-    sub = await is_subscribed(callback.bot, user.id, REQUIRE_CHANNEL)
+    # Доп. проверка подписки перед выдачей (параллельно с записью пользователя)
+    async with asyncio.TaskGroup() as tg:
+        t_sub = tg.create_task(is_subscribed(callback.bot, user.id, REQUIRE_CHANNEL))
+        tg.create_task(upsert_user(user.id, user.username))
+    sub = t_sub.result()
     if not sub:
         await callback.message.edit_text(
             "Нужно подписаться на канал для получения подарка.",
@@ -242,9 +281,9 @@ async def cb_claim(callback: types.CallbackQuery, state: FSMContext):
         )
         return
 
-    # Если запрещено выдавать повторно — проверим, что ранее не получали (по наличию в настройках)
+    # Если запрещено выдавать повторно — проверим, что ранее не получали
     if ONLY_ONCE:
-        already = await get_setting(f"gift_received_{user.id}")
+        already = await get_gift_received_at(user.id)
         if already:
             await callback.message.edit_text("Вы уже получали подарок. Спасибо!")
             return
@@ -270,7 +309,7 @@ async def cb_claim(callback: types.CallbackQuery, state: FSMContext):
 
     # Отмечаем, что выдано (для ONLY_ONCE)
     if ONLY_ONCE:
-        await set_setting(f"gift_received_{user.id}", str(int(time.time())))
+        await mark_gift_sent(user.id)
 
     await callback.message.edit_text(
         "✅ Подарок отправлен! Если это был промокод — проверьте личные сообщения."
@@ -283,11 +322,21 @@ import uvicorn
 app = FastAPI()
 webhook_ready = False
 
+# Фоновые задачи обработки апдейтов (держим ссылки, чтобы их не собрал GC)
+MAX_WEBHOOK_TASKS = int(os.getenv("MAX_WEBHOOK_TASKS", "100"))
+_webhook_tasks: set[asyncio.Task] = set()
+
+def _on_webhook_task_done(task: asyncio.Task):
+    _webhook_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Update handling failed", exc_info=task.exception())
+
 @app.on_event("startup")
 async def startup():
     await init_db()
+    # Один Bot (и одна HTTP-сессия) на весь процесс
+    bot = app.state.bot = Bot(token=BOT_TOKEN)
     # Устанавливаем команды в меню
-    bot = Bot(token=BOT_TOKEN)
     await bot.set_my_commands([
         BotCommand(command="start", description="Старт / Проверка подписки"),
         BotCommand(command="gift", description="Получить подарок"),
@@ -299,22 +348,37 @@ async def startup():
         try:
             await bot.set_webhook(url, drop_pending_updates=True)
             webhook_ready = True
-            print(f"Webhook set: {url}")
+            logger.warning("Webhook set: %s", url)
         except Exception as e:
-            print(f"Failed to set webhook: {e}")
+            logger.error("Failed to set webhook: %s", e)
     else:
         webhook_ready = False
-        print("Using long polling")
+        logger.warning("Using long polling")
+
+@app.on_event("shutdown")
+async def shutdown():
+    # даем доработать апдейтам в фоне, прежде чем закрывать сессию и БД
+    if _webhook_tasks:
+        await asyncio.gather(*_webhook_tasks, return_exceptions=True)
+    await app.state.bot.session.close()
+    await close_db()
 
 @app.post(WEBHOOK_PATH)
 async def tg_webhook(request: Request):
     if not webhook_ready:
         return Response(status_code=200)
-    bot = Bot(token=BOT_TOKEN)
-    update = await request.json()
+    bot = request.app.state.bot
+    update = orjson.loads(await request.body())
     # aiogram 3 поддерживает updates из Bot API напрямую
-    tg_update = types.Update(**update)
-    await dp.feed_update(bot=bot, update=tg_update)
+    tg_update = types.Update.model_validate(update, context={"bot": bot})
+    if len(_webhook_tasks) >= MAX_WEBHOOK_TASKS:
+        # слишком много задач в работе — обрабатываем синхронно (backpressure)
+        await dp.feed_update(bot=bot, update=tg_update)
+        return Response(status_code=200)
+    # отвечаем Telegram сразу, обработка идет в фоне
+    task = asyncio.create_task(dp.feed_update(bot=bot, update=tg_update))
+    _webhook_tasks.add(task)
+    task.add_done_callback(_on_webhook_task_done)
     return Response(status_code=200)
 
 # ---------- Main ----------
@@ -331,6 +395,7 @@ async def main():
             await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
         finally:
             await bot.session.close()
+            await close_db()
 
 if __name__ == "__main__":
     if WEBHOOK_URL: